@@ -1,16 +1,25 @@
 # ... [import e setup invariati] ...
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import numpy as np
 import folium
 from folium.plugins import MarkerCluster
 import openrouteservice
-import time
+import diskcache
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import threading
 import os
+import io
 import json
 import math
 from streamlit_folium import st_folium
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
+from geopy.extra.rate_limiter import RateLimiter
 
 # === Configurazione pagina ===
 st.set_page_config(
@@ -22,19 +31,38 @@ st.set_page_config(
 # === Funzioni di supporto ===
 @st.cache_data
 def load_school_data():
+    colonne_usate = ['Denominazione', 'Comune', 'Indirizzo', 'latitudine', 'longitudine', 'distanza_km',
+                     'km_bici', 'sum_COMUNE', 'sum_CON METODO MONTESSORI', 'sum_SOSTEGNO PSICOFISICO']
     try:
-        return pd.read_csv("mappa_scuole.csv")
+        # usecols confronta i nomi grezzi dell'intestazione: si leggono prima per accettare anche nomi con spazi
+        intestazione = pd.read_csv("mappa_scuole.csv", nrows=0).columns
+        df = pd.read_csv(
+            "mappa_scuole.csv",
+            engine="pyarrow",
+            usecols=[colonna for colonna in intestazione if colonna.strip() in colonne_usate]
+        )
     except FileNotFoundError:
         st.error("❌ File 'mappa_scuole.csv' non trovato!")
         return None
-
-def determina_fascia_distanza(distanza):
-    if distanza <= 10:
-        return "0-10 km"
-    elif distanza <= 20:
-        return "10-20 km"
-    else:
-        return "20+ km"
+    df.columns = df.columns.str.strip()
+    # I conteggi dei posti stanno in int16 e le coordinate in float32 (precisione < 1 m)
+    df = df.astype({
+        'sum_COMUNE': 'int16',
+        'sum_CON METODO MONTESSORI': 'int16',
+        'sum_SOSTEGNO PSICOFISICO': 'int16',
+        'latitudine': 'float32',
+        'longitudine': 'float32',
+        'Comune': 'category'
+    })
+    df['fascia_distanza'] = determina_fascia_distanza(df['distanza_km'])
+    return df
+
+def determina_fascia_distanza(distanze):
+    return pd.cut(
+        distanze,
+        bins=[-np.inf, 10, 20, np.inf],
+        labels=["0-10 km", "10-20 km", "20+ km"]
+    )
 
 def colore_per_fascia(fascia):
     return {
@@ -43,32 +71,116 @@ def colore_per_fascia(fascia):
         "20+ km": "red"
     }.get(fascia, "gray")
 
+def aggiungi_dati_bici(df, percorsi):
+    # Le scuole senza percorso (non ancora calcolato o in errore) mostrano "?" per tempo e distanza in bici
+    bici = pd.Series([percorsi.get(i) for i in df.index], index=df.index, dtype=object)
+    return df.assign(
+        percorso_bici=bici,
+        minuti_bici=bici.map(lambda b: b['duration_min'] if b else "?").astype(str),
+        km_percorso_bici=bici.map(lambda b: b['distance_km'] if b else "?").astype(str)
+    )
+
+def crea_popup_html(df, start):
+    # Costruisce l'HTML dei popup per tutte le scuole con operazioni vettoriali sulle colonne
+    gmaps_url = (
+        f"https://www.google.com/maps/dir/?api=1&origin={start[0]},{start[1]}&destination="
+        + df['latitudine'].astype(str) + "," + df['longitudine'].astype(str) + "&travelmode=transit"
+    )
+    return (
+        "<b>" + df['Denominazione'] + "</b><br>"
+        + "📍 <i>" + df['Indirizzo'] + "</i><br>"
+        + "📏 Distanza: " + df['distanza_km'].map("{:.1f}".format).astype(str) + " km<br>"
+        + "🚴 Bici: " + df['minuti_bici'] + " min / " + df['km_percorso_bici'] + " km<br>"
+        + "🏩 Posti Comune: " + df['sum_COMUNE'].astype(str) + "<br>"
+        + "🏫 Montessori: " + df['sum_CON METODO MONTESSORI'].astype(str) + "<br>"
+        + "🧠 Sostegno: " + df['sum_SOSTEGNO PSICOFISICO'].astype(str) + "<br>"
+        + '<a href="' + gmaps_url + '" target="_blank">🚌 Vai con i mezzi pubblici</a>'
+    )
+
+@st.cache_resource(max_entries=10)
+def crea_mappa_base(coords, indirizzo):
+    # Solo la mappa con il punto di partenza: i livelli legati ai filtri si aggiungono su una copia
+    mappa = folium.Map(location=coords, zoom_start=11, tiles="CartoDB positron")
+    folium.Marker(location=coords, popup=f"Partenza: {indirizzo}", icon=folium.Icon(color='red', icon='home', prefix='fa')).add_to(mappa)
+    return mappa
+
+@st.cache_resource
+def apri_cache_disco(percorso):
+    return diskcache.Cache(percorso)
+
+@st.cache_resource
+def get_ors_client(api_key):
+    return openrouteservice.Client(key=api_key)
+
+@st.cache_resource
+def get_ors_directions(api_key):
+    # Piano gratuito ORS: al massimo 40 richieste al minuto per le directions
+    client = get_ors_client(api_key)
+    return RateLimiter(client.directions, min_delay_seconds=60 / 40, max_retries=0, swallow_exceptions=False)
+
 @st.cache_data
-def get_route_data(start, end, comune, profile, api_key):
-    try:
-        client = openrouteservice.Client(key=api_key)
-        coords = ((start[1], start[0]), (end[1], end[0]))  # lon, lat
-        routes = client.directions(coords, profile=profile)
-        geometry = routes['routes'][0]['geometry']
-        summary = routes['routes'][0]['summary']
-        decoded = openrouteservice.convert.decode_polyline(geometry)
-        points = [(p[1], p[0]) for p in decoded['coordinates']]
-        return {
-            "points": points,
-            "duration_min": round(summary['duration'] / 60, 1),
-            "distance_km": round(summary['distance'] / 1000, 1)
-        }
-    except Exception as e:
-        st.warning(f"⚠️ Errore nel calcolo del percorso per {comune}: {e}")
-        return None
+def get_route_data(start, end, profile, api_key):
+    # st.cache_data vale solo per il processo corrente: la cache su disco sopravvive ai riavvii
+    cache = apri_cache_disco(".ors_cache")
+    chiave = f"{round(start[0], 5)},{round(start[1], 5)}|{round(end[0], 5)},{round(end[1], 5)}|{profile}"
+    percorso = cache.get(chiave)
+    if percorso is not None:
+        return percorso
+
+    directions = get_ors_directions(api_key)
+    coords = ((start[1], start[0]), (end[1], end[0]))  # lon, lat
+    routes = directions(coords, profile=profile)
+    geometry = routes['routes'][0]['geometry']
+    summary = routes['routes'][0]['summary']
+    decoded = openrouteservice.convert.decode_polyline(geometry)
+    points = [(p[1], p[0]) for p in decoded['coordinates']]
+    percorso = {
+        "points": points,
+        "duration_min": round(summary['duration'] / 60, 1),
+        "distance_km": round(summary['distance'] / 1000, 1)
+    }
+    cache[chiave] = percorso
+    return percorso
+
+def calcola_percorsi(start, destinazioni, profile, api_key, max_workers=8):
+    # Le richieste a ORS partono in parallelo; i risultati arrivano nell'ordine di 'destinazioni'
+    # e un errore viene restituito come eccezione invece di interrompere le altre richieste
+    def calcola(end):
+        try:
+            return get_route_data(start, end, profile, api_key)
+        except Exception as e:
+            return e
+
+    # I worker usano le cache di Streamlit: senza il contesto dello script ogni chiamata
+    # registra un avviso "missing ScriptRunContext"
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        yield from executor.map(calcola, destinazioni)
+
+@st.cache_resource
+def get_geocoder():
+    # Nominatim: al massimo una richiesta al secondo
+    geoloc = Nominatim(user_agent="streamlit-mappa-scuole")
+    return RateLimiter(geoloc.geocode, min_delay_seconds=1.1, max_retries=0, swallow_exceptions=False)
 
 @st.cache_data
 def geocodifica_indirizzo(indirizzo):
-    geoloc = Nominatim(user_agent="streamlit-mappa-scuole")
+    cache = apri_cache_disco(".geo_cache")
+    chiave = indirizzo.strip().lower()
+    coordinate = cache.get(chiave)
+    if coordinate is not None:
+        return coordinate
+
+    geocode = get_geocoder()
     try:
-        location = geoloc.geocode(indirizzo, timeout=10)
+        location = geocode(indirizzo, timeout=15)
         if location:
-            return location.latitude, location.longitude
+            coordinate = (location.latitude, location.longitude)
+            cache[chiave] = coordinate
+            return coordinate
         else:
             return None, None
     except GeocoderTimedOut:
@@ -93,30 +205,35 @@ mostra_posti_comune = st.sidebar.checkbox("Posti comune", value=False)
 mostra_posti_montessori = st.sidebar.checkbox("Posti montessori", value=False)
 mostra_posti_sostegno = st.sidebar.checkbox("Posti sostegno psicofisico", value=False)
 
+# I percorsi ORS si calcolano solo dopo una richiesta esplicita e solo per gli input con cui
+# sono stati richiesti: cambiare indirizzo o filtri torna alla mappa senza percorsi
+parametri_percorsi = (start_coords, tuple(fasce_selezionate), mostra_posti_comune, mostra_posti_montessori, mostra_posti_sostegno)
+if st.sidebar.button("🔄 Calcola percorsi"):
+    st.session_state.parametri_percorsi = parametri_percorsi
+calcola_percorsi_bici = st.session_state.get('parametri_percorsi') == parametri_percorsi
+
 # === Caricamento dati ===
 mappe_scuole = load_school_data()
-mappe_scuole.columns = mappe_scuole.columns.str.strip()
 
 if mappe_scuole is None:
     st.error("❌ Impossibile caricare i dati delle scuole.")
     st.stop()
 
-# === Applica fascia distanza in base a colonna 'distanza_km'
-mappe_scuole['fascia_distanza'] = mappe_scuole['distanza_km'].apply(determina_fascia_distanza)
-
-df_filtrato = mappe_scuole[mappe_scuole['fascia_distanza'].isin(fasce_selezionate)]
+mask = mappe_scuole['fascia_distanza'].isin(fasce_selezionate)
 if mostra_posti_comune:
-    df_filtrato = df_filtrato[df_filtrato['sum_COMUNE'] > 0]
+    mask &= mappe_scuole['sum_COMUNE'] > 0
 if mostra_posti_montessori:
-    df_filtrato = df_filtrato[df_filtrato['sum_CON METODO MONTESSORI'] > 0]
+    mask &= mappe_scuole['sum_CON METODO MONTESSORI'] > 0
 if mostra_posti_sostegno:
-    df_filtrato = df_filtrato[df_filtrato['sum_SOSTEGNO PSICOFISICO'] > 0]
+    mask &= mappe_scuole['sum_SOSTEGNO PSICOFISICO'] > 0
+df_filtrato = mappe_scuole.loc[mask]
 
 # === Tabs ===
 tab1, tab2 = st.tabs(["🗺️ Mappa", "📋 Tabella"])
 
 with tab1:
     st.subheader("🗺️ Mappa Interattiva")
+    conteggi_posti = (df_filtrato[['sum_COMUNE', 'sum_CON METODO MONTESSORI', 'sum_SOSTEGNO PSICOFISICO']] > 0).sum()
     col1, col2, col3, col4, col5 = st.columns(5)
     with col1:
         st.metric("📊 Totale scuole", len(df_filtrato))
@@ -124,90 +241,80 @@ with tab1:
         if len(df_filtrato) > 0:
             st.metric("📏 Distanza media", f"{df_filtrato['distanza_km'].mean():.1f} km")
     with col3:
-        st.metric("🏩 Posti Comune", len(df_filtrato[df_filtrato['sum_COMUNE'] > 0]))
+        st.metric("🏩 Posti Comune", int(conteggi_posti['sum_COMUNE']))
     with col4:
-        st.metric("🏫 Posti Montessori", len(df_filtrato[df_filtrato['sum_CON METODO MONTESSORI'] > 0]))
+        st.metric("🏫 Posti Montessori", int(conteggi_posti['sum_CON METODO MONTESSORI']))
     with col5:
-        st.metric("🧠 Posti Sostegno Psicofisico", len(df_filtrato[df_filtrato['sum_SOSTEGNO PSICOFISICO'] > 0]))
+        st.metric("🧠 Posti Sostegno Psicofisico", int(conteggi_posti['sum_SOSTEGNO PSICOFISICO']))
 
-    mappa = folium.Map(location=start_coords, zoom_start=11, tiles="CartoDB positron")
-    folium.Marker(location=start_coords, popup=f"Partenza: {indirizzo_input}", icon=folium.Icon(color='red', icon='home', prefix='fa')).add_to(mappa)
+    mappa = copy.deepcopy(crea_mappa_base(start_coords, indirizzo_input))
 
-    if len(df_filtrato) > 0:
+    percorsi = {}
+    if calcola_percorsi_bici and len(df_filtrato) > 0:
         progress_bar = st.progress(0)
         status_text = st.empty()
 
-    for i, fascia in enumerate(fasce_selezionate):
-        scuole_fascia = df_filtrato[df_filtrato['fascia_distanza'] == fascia]
-        colore_fascia = colore_per_fascia(fascia)
-        for idx, (_, row) in enumerate(scuole_fascia.iterrows()):
-            lat_scuola, lon_scuola = row["latitudine"], row["longitudine"]
-            nome = row["Denominazione"]
-            comune = row["Comune"]
-            indirizzo_scuola = row["Indirizzo"]
-            distanza_km = row['distanza_km']
+        destinazioni = list(zip(df_filtrato['latitudine'], df_filtrato['longitudine']))
+        risultati = calcola_percorsi(start_coords, destinazioni, "cycling-regular", api_key)
+        passo_progresso = max(1, len(df_filtrato) // 20)
+        for idx, (indice, comune, bici) in enumerate(zip(df_filtrato.index, df_filtrato['Comune'], risultati)):
+            if idx % passo_progresso == 0:
+                status_text.text(f"Calcolo percorso {idx+1}/{len(df_filtrato)}...")
+                progress_bar.progress((idx + 1) / len(df_filtrato))
+            if isinstance(bici, Exception):
+                st.warning(f"⚠️ Errore nel calcolo del percorso per {comune}: {bici}")
+                bici = None
+            percorsi[indice] = bici
 
-            status_text.text(f"Calcolo percorso {idx+1}/{len(scuole_fascia)} per {fascia}...")
-            progress_bar.progress((idx + 1) / len(scuole_fascia))
+        progress_bar.empty()
+        status_text.empty()
 
-            bici = get_route_data(start_coords, (lat_scuola, lon_scuola), comune, "cycling-regular", api_key)
-            minuti_bici = bici['duration_min'] if bici else "?"
-            km_bici = bici['distance_km'] if bici else "?"
+    df_mappa = aggiungi_dati_bici(df_filtrato, percorsi)
+    df_mappa = df_mappa.assign(popup_html=crea_popup_html(df_mappa, start_coords))
 
+    cluster = MarkerCluster().add_to(mappa)
+    for i, fascia in enumerate(fasce_selezionate):
+        scuole_fascia = df_mappa[df_mappa['fascia_distanza'] == fascia]
+        colore_fascia = colore_per_fascia(fascia)
+        colonne = ['latitudine', 'longitudine', 'Denominazione', 'Comune',
+                   'percorso_bici', 'minuti_bici', 'km_percorso_bici', 'popup_html']
+        for (lat_scuola, lon_scuola, nome, comune,
+             bici, minuti_bici, km_bici, popup_html) in scuole_fascia[colonne].itertuples(index=False, name=None):
             if bici:
                 folium.PolyLine(bici['points'], color=colore_fascia, weight=3, opacity=0.7, popup=f"🚴 {nome}<br>⏱️ {minuti_bici} min<br>📏 {km_bici} km").add_to(mappa)
 
-            gmaps_url = f"https://www.google.com/maps/dir/?api=1&origin={start_coords[0]},{start_coords[1]}&destination={lat_scuola},{lon_scuola}&travelmode=transit"
-
-            popup_html = f"""
-            <b>{nome}</b><br>
-            📍 <i>{indirizzo_scuola}</i><br>
-            📏 Distanza: {distanza_km:.1f} km<br>
-            🚴 Bici: {minuti_bici} min / {km_bici} km<br>
-            🏩 Posti Comune: {row['sum_COMUNE']}<br>
-            🏫 Montessori: {row['sum_CON METODO MONTESSORI']}<br>
-            🧠 Sostegno: {row['sum_SOSTEGNO PSICOFISICO']}<br>
-            <a href="{gmaps_url}" target="_blank">🚌 Vai con i mezzi pubblici</a>
-            """
-
             folium.Marker(
                 location=(lat_scuola, lon_scuola),
                 tooltip=f"{nome} ({comune}) - {fascia}",
                 popup=folium.Popup(popup_html, max_width=350),
                 icon=folium.Icon(color=colore_fascia, icon='graduation-cap', prefix='fa')
-            ).add_to(mappa)
-
-        time.sleep(4)
-
-    if len(df_filtrato) > 0:
-        progress_bar.empty()
-        status_text.empty()
+            ).add_to(cluster)
 
     st_data = st_folium(mappa, width=1200, height=700)
 
 with tab2:
     st.subheader("📋 Dettagli Scuole")
     df_display = df_filtrato[['Denominazione', 'Comune', 'Indirizzo', 'distanza_km', 'km_bici',
-                             'fascia_distanza', 'sum_COMUNE', 'sum_CON METODO MONTESSORI', 'sum_SOSTEGNO PSICOFISICO']].copy()
+                             'fascia_distanza', 'sum_COMUNE', 'sum_CON METODO MONTESSORI', 'sum_SOSTEGNO PSICOFISICO']]
     df_display.columns = ['Nome', 'Comune', 'Indirizzo', 'Distanza (km)', 'Distanza_Bici (km)', 'Fascia', 'Posti_COMUNE', 'Posti_Montessori', 'Posti_Sostegno']
     df_display = df_display.sort_values('Distanza (km)')
     st.dataframe(df_display, use_container_width=True)
 
     st.subheader("📊 Statistiche per Fascia")
-    stats_fascia = df_filtrato.groupby('fascia_distanza').agg({
-        'Denominazione': 'count',
-        'distanza_km': ['min', 'max', 'mean']
-    }).round(2)
-
-    for fascia in fasce_selezionate:
-        if fascia in stats_fascia.index:
-            count = stats_fascia.loc[fascia, ('Denominazione', 'count')]
-            min_dist = stats_fascia.loc[fascia, ('distanza_km', 'min')]
-            max_dist = stats_fascia.loc[fascia, ('distanza_km', 'max')]
-            mean_dist = stats_fascia.loc[fascia, ('distanza_km', 'mean')]
-            st.write(f"**fascia {fascia}**: {count} scuole (min: {min_dist}km, max: {max_dist}km, media: {mean_dist}km)")
-
-    csv = df_display.to_csv(index=False)
+    stats_fascia = df_filtrato.groupby('fascia_distanza', observed=True).agg(
+        count=('Denominazione', 'count'),
+        min_dist=('distanza_km', 'min'),
+        max_dist=('distanza_km', 'max'),
+        mean_dist=('distanza_km', 'mean')
+    ).round(2)
+    stats_fascia = stats_fascia.reindex([fascia for fascia in fasce_selezionate if fascia in stats_fascia.index])
+
+    for fascia, count, min_dist, max_dist, mean_dist in stats_fascia.itertuples(name=None):
+        st.write(f"**fascia {fascia}**: {count} scuole (min: {min_dist}km, max: {max_dist}km, media: {mean_dist}km)")
+
+    buffer_csv = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(df_display, preserve_index=False), buffer_csv)
+    csv = buffer_csv.getvalue()
     st.download_button(
         label="💾 Scarica dati CSV",
         data=csv,